@@ -1,4 +1,5 @@
-import os, sys, json, platform, threading, queue, time
+import os, sys, json, platform, threading, queue, time, bisect
+from collections import deque
 from datetime import datetime, timedelta
 from openpyxl import load_workbook, Workbook
 import tkinter as tk
@@ -19,30 +20,44 @@ with open(resource_path('config.json')) as f:
     cfg = json.load(f)
 NUM_STATIONS = int(cfg.get('num_stations', 8))
 DATA_FOLDER = 'data'
-TEMPLATE_PATH = resource_path('templates/excel_template.xlsx')
 CHECKPOINTS = [20, 40]  # seconds for testing
+REPROMPT_DELAY = 10     # seconds before an aborted check is offered again
 LOG_PATH = os.path.join(DATA_FOLDER, datetime.now().strftime('%Y%m%d') + '.xlsx')
+FIELDS = [
+    ('Voltage','digit'),('Current','digit'),
+    ('Clamp Current','digit'),('Temperature','digit'),
+    ('Control Light','toggle'),('Load Bank Light','toggle')
+]
+HEADERS = ('Serial','Station','Check','Scheduled','Actual','Delta',
+           *(label for label, _ in FIELDS), 'Tech', 'Status')
+STATUS_COL = HEADERS.index('Status') + 1
 
 os.makedirs(DATA_FOLDER, exist_ok=True)
-if not os.path.exists(LOG_PATH):
-    from shutil import copyfile
-    copyfile(TEMPLATE_PATH, LOG_PATH)
 
 # ── UTILS ──────────────────────────────────────────────
-def center(win, w=None, h=None):
-    win.update_idletasks()
-    width = w or win.winfo_width()
-    height = h or win.winfo_height()
-    x = (win.winfo_screenwidth() - width) // 2
-    y = (win.winfo_screenheight() - height) // 2
-    win.geometry(f"{width}x{height}+{x}+{y}")
-
-def beep():
-    if platform.system() == 'Windows':
-        import winsound; winsound.Beep(1000, 300)
-    else:
+def center(win, w, h):
+    win.geometry(f"{w}x{h}+{(SCREEN_W - w) // 2}+{(SCREEN_H - h) // 2}")
+
+if platform.system() == 'Windows':
+    import winsound
+    def beep():  # Beep blocks for its duration, keep it off the Tk thread
+        threading.Thread(target=winsound.Beep, args=(1000, 300), daemon=True).start()
+else:
+    def beep():
         print('\a', end='', flush=True)
 
+DIGITS = frozenset('0123456789')
+def two_digit_ok(P):
+    return len(P) <= 2 and all(c in DIGITS for c in P)
+
+last_ts_sec, last_ts = None, ''
+def now_ts():
+    global last_ts_sec, last_ts
+    sec = int(time.time())
+    if sec != last_ts_sec:
+        last_ts_sec, last_ts = sec, time.strftime('%H:%M:%S', time.localtime(sec))
+    return last_ts
+
 # ── DATA MODEL ─────────────────────────────────────────
 class TimerData:
     def __init__(self, serial, station, tech):
@@ -50,18 +65,19 @@ class TimerData:
         self.station = station
         self.tech = tech
         self.start = datetime.now()
+        self.targets = [self.start + timedelta(seconds=s) for s in CHECKPOINTS]
         self.done_checks = 0
         self.cancelled = False
         self.error = False
+        self.dirty = True  # static tree columns need redrawing
 
-    def next_delta(self):
+    def next_delta(self, now):
         if self.done_checks >= len(CHECKPOINTS):
             return None
-        target = self.start + timedelta(seconds=CHECKPOINTS[self.done_checks])
-        return (target - datetime.now()).total_seconds()
+        return (self.targets[self.done_checks] - now).total_seconds()
 
-    def status(self):
-        d = self.next_delta()
+    def status(self, now):
+        d = self.next_delta(now)
         if d is None:
             return '-', ''
         if d < 0:
@@ -74,13 +90,15 @@ class TimerData:
 root = tb.Window(themename='litera')
 root.title('Device Logger')
 root.attributes('-fullscreen', True)
+SCREEN_W, SCREEN_H = root.winfo_screenwidth(), root.winfo_screenheight()
+two_digit_vcmd = (root.register(two_digit_ok), '%P')
 
 serial_var = tk.StringVar()
 tech_var = tk.StringVar()
 timers = {}
-prompt_q = queue.Queue()
-prompt_lock = threading.Semaphore(1)
-activity_log = []
+active_stations = []  # sorted keys of timers
+popup_active = False  # a check popup is open
+activity_log = deque(maxlen=5)
 
 # ── TREEVIEW ───────────────────────────────────────────
 cols = ('Station','Serial','Tech','Progress','Next','Error','Overdue')
@@ -90,41 +108,122 @@ for c in cols:
     tree.column(c, anchor='center')
 tree.pack(fill='both', expand=True)
 
-def refresh_tree():
-    sel = tree.selection()
-    sel_st = tree.item(sel[0])['values'][0] if sel else None
-    tree.delete(*tree.get_children())
-    for st, td in sorted(timers.items()):
+tree_iids = {}  # station -> treeview item
+needs_redraw = threading.Event()  # timer state changed since last redraw
+last_sec = None
+
+def refresh_tree(now):
+    for st in set(tree_iids) - set(timers):
+        tree.delete(tree_iids.pop(st))
+    for i, st in enumerate(active_stations):
+        td = timers[st]
+        nxt, ov = td.status(now)
+        if st in tree_iids and not td.dirty:
+            tree.set(tree_iids[st], 'Next', nxt); tree.set(tree_iids[st], 'Overdue', ov)
+            continue
         prog = f"{td.done_checks}/{len(CHECKPOINTS)}"
-        nxt, ov = td.status()
         err = '❌' if td.error else ''
-        iid = tree.insert('', 'end', values=(st, td.serial, td.tech, prog, nxt, err, ov))
-        if sel_st == st:
-            tree.selection_set(iid)
-    root.after(1000, refresh_tree)
-refresh_tree()
+        values = (st, td.serial, td.tech, prog, nxt, err, ov)
+        if st in tree_iids:
+            tree.item(tree_iids[st], values=values)
+        else:
+            tree_iids[st] = tree.insert('', i, values=values)
+        td.dirty = False
+
+def tick():
+    global last_sec
+    now = datetime.now()
+    if needs_redraw.is_set() or int(now.timestamp()) != last_sec:
+        needs_redraw.clear(); last_sec = int(now.timestamp())
+        refresh_tree(now)
+    root.after(200, tick)
+tick()
 
 # ── LOG AREA ───────────────────────────────────────────
 logbox = tk.Listbox(root, height=5, font=('Consolas',10), bg='#f7f7f7')
 logbox.pack(fill='x')
 def log(msg):
-    ts = datetime.now().strftime('%H:%M:%S')
-    activity_log.insert(0, f"[{ts}] {msg}")
-    logbox.delete(0, tk.END)
-    for e in activity_log[:5]:
-        logbox.insert(tk.END, e)
+    entry = f"[{now_ts()}] {msg}"
+    activity_log.appendleft(entry)
+    logbox.insert(0, entry)
+    if logbox.size() > activity_log.maxlen:
+        logbox.delete(tk.END)
 
 # ── EXCEL I/O ──────────────────────────────────────────
-def write_excel(row):
+EXCEL_BATCH = 50  # max queued ops applied per save
+SAVE_RETRY = 5    # seconds between retries of a failed save
+excel_unsaved = False  # ws holds changes not yet saved to LOG_PATH
+if os.path.exists(LOG_PATH):
     wb = load_workbook(LOG_PATH)
     ws = wb.active
-    ws.append(row)
+    if ws.cell(row=1, column=STATUS_COL).value is None:
+        ws.cell(row=1, column=STATUS_COL).value = 'Status'
+else:
+    wb = Workbook()
+    ws = wb.active
+    ws.append(HEADERS)
     wb.save(LOG_PATH)
+excel_q = queue.SimpleQueue()  # ('append', row) / ('cancel', station) / None to stop
+station_rows = {}  # station -> worksheet row numbers not yet cancelled
+for r,row in enumerate(ws.iter_rows(min_row=2, min_col=2, max_col=STATUS_COL, values_only=True), start=2):
+    if row[-1] != 'CANCELLED': station_rows.setdefault(row[0], []).append(r)
+
+def apply_excel(item):
+    op, arg = item
+    if op == 'append':
+        ws.append(arg); station_rows.setdefault(arg[1], []).append(ws.max_row)
+    elif op == 'cancel':
+        for r in station_rows.pop(arg, []): ws.cell(row=r, column=STATUS_COL).value = 'CANCELLED'
+
+def excel_writer():
+    global excel_unsaved
+    while True:
+        try:
+            batch = [excel_q.get(timeout=SAVE_RETRY if excel_unsaved else None)]
+        except queue.Empty:
+            batch = []  # nothing new, just retry the failed save
+        try:
+            while len(batch) < EXCEL_BATCH: batch.append(excel_q.get_nowait())
+        except queue.Empty:
+            pass
+        stop = None in batch
+        for item in batch:
+            if item is None: break
+            try:
+                apply_excel(item); excel_unsaved = True
+            except Exception as e:
+                if not stop: root.after(0, log, f'⚠ Excel update failed: {e}')
+        if excel_unsaved:
+            try:
+                wb.save(LOG_PATH); excel_unsaved = False
+            except Exception as e:
+                # rows stay in ws and go out with the next successful save
+                if not stop: root.after(0, log, f'⚠ Excel save failed, retrying: {e}')
+        if stop: return
+excel_thread = threading.Thread(target=excel_writer, daemon=True)
+excel_thread.start()
+
+def write_excel(row):
+    excel_q.put(('append', row))
+
+def flush_excel():
+    global excel_unsaved
+    if excel_thread.is_alive():
+        excel_q.put(None); excel_thread.join()
+    if excel_unsaved:
+        try:
+            wb.save(LOG_PATH); excel_unsaved = False
+        except Exception:
+            pass
+    return not excel_unsaved
+
+def cancel_station_rows(st):
+    excel_q.put(('cancel', st))
 
 # ── SCAN DIALOG ───────────────────────────────────────
-def scan(prompt):
+def scan(prompt, on_ok, on_close=None):
     win = tk.Toplevel(root)
-    win.title(prompt)
+    win.title(prompt); center(win, 300, 150)
     win.transient(root); win.grab_set(); win.focus_force()
     ttk.Label(win, text=prompt).pack(pady=10)
     var = tk.StringVar()
@@ -135,57 +234,68 @@ def scan(prompt):
             messagebox.showerror('Invalid', prompt)
             return
         win.grab_release(); win.destroy()
+        on_ok(var.get().strip())
+    def close():
+        win.grab_release(); win.destroy()
+        if on_close: on_close()
     ent.bind('<Return>', ok)
+    win.protocol('WM_DELETE_WINDOW', close)
     ttk.Button(win, text='Confirm', command=ok).pack(pady=5)
-    center(win, 300, 150)
-    win.wait_window()
-    return var.get().strip()
 
 # ── DATA ENTRY POPUP ───────────────────────────────────
-def prompt_user(serial, station, idx, sched_time, tech):
-    def popup():
-        prompt_lock.acquire(); beep()
+def prompt_user(td, idx, sched_time):
+    global popup_active
+    serial, station, tech = td.serial, td.station, td.tech
+    if timers.get(station) is not td or td.cancelled: return  # run cancelled or replaced
+    if popup_active:
+        root.after(500, prompt_user, td, idx, sched_time); return
+    popup_active = True; beep()
+    def release():
+        global popup_active
+        popup_active = False
+    def retry():
+        release(); root.after(REPROMPT_DELAY*1000, prompt_user, td, idx, sched_time)
+    def verify(user_serial):
         # 1) Serial verification
-        user_serial = scan(f"Rescan Serial for Station {station}")
         if user_serial != serial:
             messagebox.showerror('Mismatch','Serial numbers don\'t match.')
-            prompt_lock.release(); return
+            retry(); return
         # 2) Entry window
         win = tk.Toplevel(root)
         win.title(f'Station {station} – Check {idx}')
         win.transient(root); win.grab_set(); win.focus_force()
-        win.geometry('600x400'); center(win,600,400)
-        fields = [
-            ('Voltage','digit'),('Current','digit'),
-            ('Clamp Current','digit'),('Temperature','digit'),
-            ('Control Light','toggle'),('Load Bank Light','toggle')
-        ]
+        center(win,600,400)
+        def close():
+            win.grab_release(); win.destroy(); release()
+        def abort():
+            win.grab_release(); win.destroy(); retry()
+        win.protocol('WM_DELETE_WINDOW', abort)
         entries = {}
         widgets = {}
         def save():
             row = [serial, station, idx, sched_time.strftime('%H:%M:%S'),
-                   datetime.now().strftime('%H:%M:%S'), abs(int((datetime.now()-sched_time).total_seconds()))]
-            for label, ftype in fields:
+                   now_ts(), abs(int((datetime.now()-sched_time).total_seconds()))]
+            for label, ftype in FIELDS:
                 if ftype == 'digit':
                     e1, e2 = widgets[label]
                     row.append(f"{e1.get().zfill(2)}.{e2.get().zfill(2)}")
                 else:
                     row.append(widgets[label].get())
             row.append(tech)
-            timers[station].error = any(widgets[l].get()=='OFF' for l in ('Control Light','Load Bank Light'))
-            timers[station].done_checks += 1
+            td.error = any(widgets[l].get()=='OFF' for l in ('Control Light','Load Bank Light'))
+            td.done_checks += 1
+            td.dirty = True; needs_redraw.set()
             write_excel(row); log(f'✅ Logged Check {idx} for Station {station}')
-            win.grab_release(); win.destroy(); prompt_lock.release()
+            close()
         def ask(i=0):
             for w in win.winfo_children(): w.destroy()
-            label, ftype = fields[i]
+            label, ftype = FIELDS[i]
             ttk.Label(win, text=label).pack(pady=10)
             if ftype == 'digit':
                 iv, dv = tk.StringVar(), tk.StringVar()
-                vcmd = (win.register(lambda P: (P.isdigit() and len(P)<=2) or P==''), '%P')
                 frm = ttk.Frame(win); frm.pack()
-                e1 = ttk.Entry(frm, textvariable=iv, width=3, validate='key', validatecommand=vcmd)
-                e2 = ttk.Entry(frm, textvariable=dv, width=3, validate='key', validatecommand=vcmd)
+                e1 = ttk.Entry(frm, textvariable=iv, width=3, validate='key', validatecommand=two_digit_vcmd)
+                e2 = ttk.Entry(frm, textvariable=dv, width=3, validate='key', validatecommand=two_digit_vcmd)
                 e1.pack(side='left'); ttk.Label(frm, text='.').pack(side='left'); e2.pack(side='left')
                 e1.focus(); e1.bind('<KeyRelease>', lambda e: e2.focus() if len(iv.get())==2 else None)
                 def enter(e=None): entries[label]=(iv,dv); next_field()
@@ -197,14 +307,14 @@ def prompt_user(serial, station, idx, sched_time, tech):
                 ttk.Button(f, text='OFF', command=lambda v=var: v.set('OFF')).pack(side='left', expand=True, fill='x')
                 ttk.Button(win, text='Enter', command=next_field).pack(pady=10)
         def next_field():
-            if len(entries)<len(fields): ask(len(entries))
+            if len(entries)<len(FIELDS): ask(len(entries))
             else: review()
         def review():
             for w in win.winfo_children(): w.destroy()
             win.protocol('WM_DELETE_WINDOW', save)
             ttk.Label(win, text='Review All Data').pack(pady=10)
             grid = ttk.Frame(win); grid.pack()
-            for r,(label,ftype) in enumerate(fields):
+            for r,(label,ftype) in enumerate(FIELDS):
                 ttk.Label(grid, text=label).grid(row=r, column=0, padx=5, pady=5)
                 if ftype=='digit':
                     iv,dv=entries[label]
@@ -218,20 +328,18 @@ def prompt_user(serial, station, idx, sched_time, tech):
                     cb.grid(row=r,column=1,columnspan=3,sticky='ew')
                     widgets[label]=var
             ttk.Button(win, text='Confirm & Save', command=save).pack(pady=15)
-            center(win,600,400)
         ask(0)
-    threading.Thread(target=popup, daemon=True).start()
+    scan(f"Rescan Serial for Station {station}", verify, on_close=retry)
 
-# ── SCHEDULER & QUEUE ─────────────────────────────────
+# ── SCHEDULER ─────────────────────────────────────────
 def schedule(serial, station, tech):
+    if station not in timers: bisect.insort(active_stations, station)
     td=TimerData(serial,station,tech); timers[station]=td
-    def worker(idx,delay,start):
-        time.sleep(delay)
-        if not td.cancelled: prompt_q.put((serial,station,idx,start+timedelta(seconds=sum(CHECKPOINTS[:idx])),tech))
+    def fire(idx):
+        prompt_user(td,idx,td.targets[idx-1])
     for i,sec in enumerate(CHECKPOINTS,start=1):
-        threading.Thread(target=worker,args=(i,sec,td.start),daemon=True).start()
-    log(f'⏱ Started Station {station} ({serial})')
-threading.Thread(target=lambda:[prompt_user(*prompt_q.get()) for _ in iter(int,1)],daemon=True).start()
+        root.after(sec*1000, fire, i)
+    needs_redraw.set(); log(f'⏱ Started Station {station} ({serial})')
 
 # ── BUTTON BAR ────────────────────────────────────────
 bar=ttk.Frame(root); bar.pack(fill='x',pady=5)
@@ -241,28 +349,31 @@ ttk.Entry(bar,textvariable=tech_var).pack(side='left',padx=5)
 
 def start():
     if not tech_var.get().strip(): messagebox.showerror('Tech','Enter technician name'); return
-    serial=scan('Scan Serial Number')
-    while True:
-        st_str=scan(f'Scan Station Number (1–{NUM_STATIONS})')
-        if not st_str.isdigit(): messagebox.showerror('Invalid','Station must be a number'); continue
+    tech=tech_var.get().strip()
+    scan('Scan Serial Number', lambda serial: scan_station(serial, tech))
+
+def scan_station(serial, tech):
+    def got(st_str):
+        if not st_str.isdigit(): messagebox.showerror('Invalid','Station must be a number'); scan_station(serial, tech); return
         st=int(st_str)
-        if st<1 or st>NUM_STATIONS: messagebox.showerror('Invalid',f'Station must be 1–{NUM_STATIONS}'); continue
-        break
-    if st in timers and timers[st].done_checks<len(CHECKPOINTS) and not timers[st].cancelled: messagebox.showerror('Busy',f'Station {st} already active'); return
-    schedule(serial,st,tech_var.get().strip())
+        if st<1 or st>NUM_STATIONS: messagebox.showerror('Invalid',f'Station must be 1–{NUM_STATIONS}'); scan_station(serial, tech); return
+        if st in timers and timers[st].done_checks<len(CHECKPOINTS) and not timers[st].cancelled: messagebox.showerror('Busy',f'Station {st} already active'); return
+        schedule(serial,st,tech)
+    scan(f'Scan Station Number (1–{NUM_STATIONS})', got)
 
 def cancel():
     sel=tree.selection();
     if not sel: messagebox.showerror('Select','Select a station'); return
     st=tree.item(sel[0])['values'][0]
     if not messagebox.askyesno('Cancel',f'Cancel Station {st}?'): return
-    td=timers.pop(st); td.cancelled=True
-    wb=load_workbook(LOG_PATH); ws=wb.active
-    for r,row in enumerate(list(ws.iter_rows(min_row=2)),start=2):
-        if row[1].value==st: ws.delete_rows(r)
-    wb.save(LOG_PATH); log(f'❌ Cancelled Station {st}')
+    td=timers.pop(st); td.cancelled=True; td.dirty=True
+    active_stations.remove(st); needs_redraw.set()
+    cancel_station_rows(st)
+    log(f'❌ Cancelled Station {st}')
 
 ttk.Button(bar,text='Start',command=start).pack(side='left',padx=5)
 ttk.Button(bar,text='Cancel',command=cancel).pack(side='left',padx=5)
 
 root.mainloop()
+while not flush_excel():
+    if not messagebox.askretrycancel('Excel', f'Could not save {LOG_PATH}.\nClose it in Excel and retry.'): break
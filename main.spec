@@ -5,7 +5,7 @@ a = Analysis(
     ['main.py'],
     pathex=[],
     binaries=[],
-    datas=[('config.json', '.'), ('templates/excel_template.xlsx', 'templates')],
+    datas=[('config.json', '.')],
     hiddenimports=['openpyxl'],
     hookspath=[],
     hooksconfig={},